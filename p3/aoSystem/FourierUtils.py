@@ -1002,24 +1002,41 @@ def getFWHM(psf,pixelScale,rebin=1,method='contour',nargout=2,center=None,std_gu
     elif nargout == 4:
         return FWHMx,FWHMy,aRatio,theta
                           
+_OTF_DL_CACHE = {}
+
+def diffractionLimitOtf(pupil,samp,notf):
+    '''
+        Normalized diffraction-limit OTF of the pupil interpolated on a notf
+        support. The result is cached : the pupil FFT is identical for every
+        PSF of a fit or of a batch, so it is only computed once per
+        pupil/sampling/support combination.
+    '''
+    key = (id(pupil),pupil.shape,float(samp),tuple(int(n) for n in notf))
+    hit = _OTF_DL_CACHE.get(key)
+    if hit is not None and hit[0] is pupil:
+        return hit[1]
+    pup_pad = enlargeSupport(pupil,samp)
+    otfDL   = fft.fftshift(abs(fft.ifft2(fft.fft2(fft.fftshift(pup_pad))**2)))
+    otfDL   = interpolateSupport(otfDL,notf)
+    otfDL   = otfDL/otfDL.max()
+    # keeping the pupil reference makes the id-based key stable
+    _OTF_DL_CACHE[key] = (pupil,otfDL)
+    return otfDL
+
 def getStrehl(psf0,pupil,samp,recentering=False,nR=5,method='otf'):
-    if recentering:    
+    if recentering:
         psf = centerPsf(psf0,2)
     else:
         psf = psf0
-        
+
     if method == 'otf':
         #% Get the OTF
         otf     = fft.fftshift(psf2otf(psf))
         otf     = otf/otf.max()
         notf    = np.array(otf.shape)
-        
-        # Get the Diffraction-limit OTF
-        nX,nY   = pupil.shape
-        pup_pad = enlargeSupport(pupil,samp)
-        otfDL   = fft.fftshift(abs(fft.ifft2(fft.fft2(fft.fftshift(pup_pad))**2)))
-        otfDL   = interpolateSupport(otfDL,notf)
-        otfDL   = otfDL/otfDL.max()
+
+        # Get the Diffraction-limit OTF (cached)
+        otfDL   = diffractionLimitOtf(pupil,samp,notf)
         # Get the Strehl
         SR      = np.real(otf.sum()/otfDL.sum())
     elif method == 'max':
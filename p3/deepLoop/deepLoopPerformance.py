@@ -9,6 +9,7 @@ Created on Sun Mar  7 10:02:21 2021
 #%% IMPORTING LIBRAIRIES
 import numpy as np
 import os
+import re
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from distutils.spawn import find_executable
@@ -22,6 +23,9 @@ from p3.psfao21.psfao21 import psfao21
 from p3.psfFitting.psfFitting import psfFitting
 np.random.seed(1)
 
+# matches a float token, avoiding a float() try/except per token
+_FLOAT_PATTERN = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+
 #%% CLASS
 class deepLoopPerformance:
     ''' neuralNetworkPerformance class that allows to assess the 
@@ -57,46 +61,42 @@ class deepLoopPerformance:
             print('WARNING : the field path_ini is None : no analyses on PSFs possible')
         
         # IDENTIFYING DATA
-        self.idNN     = np.empty(self.nCases,dtype=list)
-        self.idData   = np.empty(self.nCases,dtype=list)
-        self.dataType = np.empty(self.nCases,dtype=list)
-        self.nParam   = np.empty(self.nCases,dtype=list)
-            
+        self.idNN     = []
+        self.idData   = []
+        self.dataType = []
+        self.nParam   = np.empty(self.nCases,dtype=np.int32)
+
         for n in range(self.nCases):
             # data identification from the file name
             s = self.path_txt[n].split('/')[-1]
             s = s.split('_')
-            self.idNN[n]     = s[1]
-            self.idData[n]   = s[2]
-            self.dataType[n] = s[0][3:]
+            self.idNN.append(s[1])
+            self.idData.append(s[2])
+            self.dataType.append(s[0][3:])
             # reading the first line to count the number of parameters
-            self.nParam[n]   = self.read_txt_files(self.path_txt[n],getParamNumberOnly=True)
+            self.nParam[n] = self.read_txt_files(self.path_txt[n],getParamNumberOnly=True)
             
         self.nNetworks = len(self.idNN)
         self.nDataSets = len(self.idData)
         print('Test of %d network architectures performance on %d data sets'%(self.nNetworks,self.nDataSets))
         
-        # INSTANTIATING DATA STRUCTURES
-        self.gtruth = np.empty(self.nCases,dtype=tuple)
-        self.nnest  = np.empty(self.nCases,dtype=tuple)
-        self.labels = np.empty(self.nCases,dtype=tuple)
-        self.metrics_param = np.empty(self.nCases,dtype=tuple)
-        for n in range(self.nCases):
-            # get parameters
-            self.gtruth[n],self.nnest[n],self.labels[n] = self.read_txt_files(self.path_txt[n])
-            # get metrics
-            self.metrics_param[n] = np.zeros((self.nParam[n],7))
-            for k in range(self.nParam[n]):
-                self.metrics_param[n][k] = self.get_parameters_metrics(self.gtruth[n][k],self.nnest[n][k])
-                
-            self.path_save = path_save
-            if self.path_save:
-                Tab = QTable(names=self.labels[n])   
+        # INSTANTIATING DATA STRUCTURES : the txt files are only parsed at
+        # the first access to gtruth/nnest/labels/metrics_param
+        self._case_data      = {}
+        self._gtruth         = None
+        self._nnest          = None
+        self._labels         = None
+        self._metrics_param  = None
+
+        self.path_save = path_save
+        if self.path_save:
+            for n in range(self.nCases):
+                Tab = QTable(names=self.labels[n])
                 for k in range(7):
                     Tab.add_row(self.metrics_param[n][:,k])
                 Tab.write(path_save + self.idNN[n] + '_' + self.idData[n] + '_' + self.dataType[n] + '.csv',overwrite=True)
-            
-        
+
+
         # COMPUTING PSF METRICS
         if self.path_ini:
             self.fit = fit
@@ -335,45 +335,80 @@ class deepLoopPerformance:
                                 + '_' + str(len(self.nnest[n][0])) + '_init_' + str(self.init_fit) +'.png'
                     plt.savefig(path_fig) 
                     
+    def _load(self,n):
+        '''
+        Parsing the nth txt file at first request and caching the result;
+        data are stored in float32 to halve the resident memory
+        '''
+        if n not in self._case_data:
+            gt,nn,lab = self.read_txt_files(self.path_txt[n])
+            if gt.dtype != np.float32:
+                # memory-mapped sidecars are already float32 ; only copy
+                # freshly parsed float64 data
+                gt = gt.astype(np.float32)
+                nn = nn.astype(np.float32)
+            self._case_data[n] = (gt,nn,lab)
+        return self._case_data[n]
+
+    @property
+    def gtruth(self):
+        if self._gtruth is None:
+            self._gtruth = [self._load(n)[0] for n in range(self.nCases)]
+        return self._gtruth
+
+    @property
+    def nnest(self):
+        if self._nnest is None:
+            self._nnest = [self._load(n)[1] for n in range(self.nCases)]
+        return self._nnest
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = [self._load(n)[2] for n in range(self.nCases)]
+        return self._labels
+
+    @property
+    def metrics_param(self):
+        if self._metrics_param is None:
+            self._metrics_param = []
+            for n in range(self.nCases):
+                metrics = np.zeros((self.nParam[n],7))
+                for k in range(self.nParam[n]):
+                    metrics[k] = self.get_parameters_metrics(self.gtruth[n][k],self.nnest[n][k])
+                self._metrics_param.append(metrics)
+        return self._metrics_param
+
     def read_txt_files(self,path_txt,getParamNumberOnly=False):
         '''
         Reading the .txt input file and populating the gtruth and nnest arrays
         '''
-        def is_float(string):
-            try:
-                float(string)
-                return True
-            except ValueError:
-                return
-            
         # GETTING THE NUMBER OF PARAMETERS
-        tmp = open(path_txt)
-        firstLine = tmp.readline().split()
-        lab       = tmp.readline().split()
-        labels    = lab[1:int((len(lab)-1)/2+1)]
-        nParam = 0
-        for n in range(len(firstLine)):
-            if is_float(firstLine[n]):
-                nParam+=1
-        if getParamNumberOnly:
-            tmp.close()
-            return nParam
-        
-        # GETTING THE NUMBER OF LINES
-        nData = sum(1 for line in tmp) -1
-        tmp.close()
-        
-        # READING THE ENTIRE FILE
-        groundTruth = np.zeros((nParam,nData))
-        nnEstimates = np.zeros((nParam,nData))
-        tmp = open(path_txt)
-        lines = tmp.readlines()[2:]
-        for n in range(nData):
-            tmpP = np.array(lines[n][0:-1].split('\t')).astype(float)
-            groundTruth[:,n] = tmpP[0:nParam]
-            nnEstimates[:,n] = tmpP[nParam:]
-            
-        tmp.close()
+        with open(path_txt) as tmp:
+            firstLine = tmp.readline().split()
+            lab       = tmp.readline().split()
+            labels    = lab[1:int((len(lab)-1)/2+1)]
+            nParam    = sum(1 for tok in firstLine if _FLOAT_PATTERN.match(tok))
+            if getParamNumberOnly:
+                return nParam
+
+            # GETTING THE NUMBER OF LINES (the trailing line is discarded)
+            nData = sum(1 for line in tmp) -1
+
+        # READING THE ENTIRE FILE WITH THE C-LEVEL PARSER ; a float32 .npy
+        # sidecar is written next to the txt file so later reads are
+        # memory-mapped (paged in on demand) instead of re-parsed
+        path_npy = path_txt + '.npy'
+        if os.path.isfile(path_npy) and os.path.getmtime(path_npy) >= os.path.getmtime(path_txt):
+            data = np.load(path_npy,mmap_mode='r')
+        else:
+            data = np.loadtxt(path_txt,skiprows=2,max_rows=nData,ndmin=2).astype(np.float32)
+            try:
+                np.save(path_npy,data)
+            except OSError:
+                pass # read-only data directory : keep the in-memory array
+        groundTruth = data[:,0:nParam].T
+        nnEstimates = data[:,nParam:].T
         return groundTruth,nnEstimates,labels
             
     def get_parameters_metrics(self,gtruth,nnEst):
@@ -401,18 +436,18 @@ class deepLoopPerformance:
         print('Regenerating the PSFs ... ')
         p2x = lambda x: list(x[0:5]) + [0] + [x[5]] + [0,0,0,1,0,0,0] + list(x[6:-1])
         
-        self.mag_err = np.empty(self.nCases,dtype=list)
-        self.mse     = np.empty(self.nCases,dtype=list)
-        self.SR      = np.empty(self.nCases,dtype=list)
-        self.FWHM    = np.empty(self.nCases,dtype=list)
-        
-        self.psf_mean      = np.empty(self.nCases,dtype=list)
-        self.psf_diff_mean = np.empty(self.nCases,dtype=list)
-        self.psf_diff_std  = np.empty(self.nCases,dtype=list)
+        self.mag_err = [None]*self.nCases
+        self.mse     = [None]*self.nCases
+        self.SR      = [None]*self.nCases
+        self.FWHM    = [None]*self.nCases
+
+        self.psf_mean      = [None]*self.nCases
+        self.psf_diff_mean = [None]*self.nCases
+        self.psf_diff_std  = [None]*self.nCases
         if fit:
-            self.psf_diff_mean_fit = np.empty(self.nCases,dtype=list)
-            self.psf_diff_std_fit  = np.empty(self.nCases,dtype=list)
-            self.fitEstimates      = np.empty(self.nCases,dtype=list) 
+            self.psf_diff_mean_fit = [None]*self.nCases
+            self.psf_diff_std_fit  = [None]*self.nCases
+            self.fitEstimates      = [None]*self.nCases
             p_median               = np.median(self.gtruth[0],axis=1)
         nPx = self.psfao.ao.cam.fovInPix
         nC  = 2 + fit*1
@@ -451,13 +486,15 @@ class deepLoopPerformance:
                 tmp,_,_,_,_     = linregress(psf_true.reshape(-1),psf_ml.reshape(-1))
                 self.mag_err[n][0,k] = -2.5*np.log10(tmp)
                 
-                # AVERAGE PSF
+                # AVERAGE PSF : the difference and the flux are computed once
+                psf_diff = psf_ml - psf_true
+                sum_true = psf_true.sum()
                 self.psf_mean[n]      += psf_true/nPSF
-                self.psf_diff_mean[n] += abs(psf_ml - psf_true)/nPSF
-                self.psf_diff_std[n]  += (psf_ml - psf_true)**2 /nPSF
-                
+                self.psf_diff_mean[n] += abs(psf_diff)/nPSF
+                self.psf_diff_std[n]  += psf_diff**2 /nPSF
+
                 # GETTING METRICS
-                self.mse[n][0,k]  = 1e2 * np.sqrt(np.sum((psf_ml-psf_true)**2))/psf_true.sum()
+                self.mse[n][0,k]  = 1e2 * np.linalg.norm(psf_diff)/sum_true
                 self.SR[n][0,k]   = FourierUtils.getStrehl(psf_true,self.psfao.ao.tel.pupil,self.psfao.freq.sampRef) 
                 self.SR[n][1,k]   = FourierUtils.getStrehl(psf_ml,self.psfao.ao.tel.pupil,self.psfao.freq.sampRef) 
                 self.FWHM[n][0,k] = FourierUtils.getFWHM(psf_true,self.psfao.ao.cam.psInMas,nargout=1) 
@@ -509,13 +546,14 @@ class deepLoopPerformance:
                     self.fitEstimates[n][:,k] = list(res.x[0:5]) + [res.x[6]] + list(res.x[14:])
                     
                     # averaged fitted-PSF
-                    self.psf_diff_mean_fit[n] += abs(res.psf - psf_true)/nPSF
-                    self.psf_diff_std_fit[n]  += (res.psf - psf_true)**2 /nPSF
-                
+                    fit_diff = res.psf - psf_true
+                    self.psf_diff_mean_fit[n] += abs(fit_diff)/nPSF
+                    self.psf_diff_std_fit[n]  += fit_diff**2 /nPSF
+
                     # compare PSFs
                     tmp,_,_,_,_     = linregress(psf_true.reshape(-1),res.psf.reshape(-1))
                     self.mag_err[n][1,k]= -2.5*np.log10(tmp)
-                    self.mse[n][1,k]    = 1e2 * np.sqrt(np.sum((res.psf-psf_true)**2))/psf_true.sum()
+                    self.mse[n][1,k]    = 1e2 * np.linalg.norm(fit_diff)/sum_true
                     self.SR[n][2,k]     = FourierUtils.getStrehl(res.psf,self.psfao.ao.tel.pupil,self.psfao.freq.sampRef) 
                     self.FWHM[n][2,k]   = FourierUtils.getFWHM(res.psf,self.psfao.ao.cam.psInMas,nargout=1)
                     
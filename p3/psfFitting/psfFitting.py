@@ -7,8 +7,17 @@ Created on Wed Feb 17 10:33:19 2021
 """
 
 #%% MANAGE PYTHON LIBRAIRIES
+import os
+import sys
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from scipy.optimize import least_squares
+from scipy.optimize import least_squares, OptimizeResult
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
 import p3.aoSystem.FourierUtils as FourierUtils
 from p3.psfFitting.confidenceInterval import confidence_interval
 from p3.psfFitting.imageModel import imageModel
@@ -16,9 +25,79 @@ from p3.psfFitting.imageModel import imageModel
 import matplotlib.pyplot as plt
 
 #%%
+_JAC_COST = None
+
+def _jac_column(y):
+    # evaluate the cost function in a worker process; _JAC_COST is
+    # inherited from the parent process at fork time
+    return _JAC_COST(y)
+
+def _lm_deferred(fun,jac,y0,bounds=None,ftol=1e-8,xtol=1e-8,gtol=1e-8,max_nfev=1000):
+    """Levenberg-Marquardt loop that only recomputes the Jacobian when a trial
+    step is accepted; scipy's least_squares reevaluates it at every iteration,
+    so deferring it saves the dominant finite-difference cost on rejections.
+    Bounds are enforced by projecting the trial step. Returns an OptimizeResult
+    compatible with the least_squares output."""
+    y = np.asarray(y0,dtype=float)
+    if bounds is not None:
+        b_low = np.asarray(bounds[0],dtype=float)
+        b_up  = np.asarray(bounds[1],dtype=float)
+        y     = np.clip(y,b_low,b_up)
+    f    = fun(y)
+    nfev = 1
+    cost = 0.5*np.dot(f,f)
+    J    = jac(y)
+    njev = 1
+    lam  = 1e-3
+    status  = 0
+    message = 'The maximum number of function evaluations is exceeded.'
+    while nfev < max_nfev:
+        g = J.T.dot(f)
+        if np.linalg.norm(g,np.inf) < gtol:
+            status  = 1
+            message = '`gtol` termination condition is satisfied.'
+            break
+        JTJ = J.T.dot(J)
+        D   = np.diag(JTJ).copy()
+        D[D == 0] = 1.0
+        try:
+            step = np.linalg.solve(JTJ + lam*np.diag(D),-g)
+        except np.linalg.LinAlgError:
+            lam *= 10
+            continue
+        y_new = y + step
+        if bounds is not None:
+            y_new = np.clip(y_new,b_low,b_up)
+        f_new    = fun(y_new)
+        nfev    += 1
+        cost_new = 0.5*np.dot(f_new,f_new)
+        if cost_new < cost:
+            dcost = cost - cost_new
+            dy    = np.linalg.norm(y_new - y)
+            y,f,cost = y_new,f_new,cost_new
+            lam   = max(lam/10,1e-12)
+            if dcost <= ftol*cost:
+                status  = 2
+                message = '`ftol` termination condition is satisfied.'
+                break
+            if dy <= xtol*(xtol + np.linalg.norm(y)):
+                status  = 3
+                message = '`xtol` termination condition is satisfied.'
+                break
+            # the Jacobian is refreshed on accepted steps only
+            J     = jac(y)
+            njev += 1
+        else:
+            lam *= 10
+
+    return OptimizeResult(x=y,fun=f,jac=J,cost=cost,optimality=np.linalg.norm(J.T.dot(f),np.inf),
+                          nfev=nfev,njev=njev,status=status,success=status > 0,message=message,
+                          active_mask=np.zeros_like(y))
+
 def psfFitting(image,psfModelInst,x0,weights=None,fixed=None,method='trf',spectralStacking=True,
                spatialStacking=True,normType=1, bounds=None,
-               ftol=1e-8,xtol=1e-8,gtol=1e-8,max_nfev=1000,verbose=0):
+               ftol=1e-8,xtol=1e-8,gtol=1e-8,max_nfev=1000,verbose=0,numJacWorkers=1,
+               trSolver='auto',singlePrecision=False):
     """Fit a PSF with a parametric model solving the least-square problem
        epsilon(x) = SUM_pixel { weights * (amp * Model(x) + bck - psf)² }
     
@@ -36,7 +115,9 @@ def psfFitting(image,psfModelInst,x0,weights=None,fixed=None,method='trf',spectr
         Default: uniform weighting
     fixed : numpy.ndarray
         Fix some parameters to their initial value (default: None)
-    method : str or callable, optional : trf, dogbox or lm
+    method : str or callable, optional : trf, dogbox, lm or lmq
+        'lmq' is a bounded Levenberg-Marquardt loop that reuses the Jacobian
+        on rejected steps, saving finite-difference evaluations.
     ftol, xtol, gtol:float, optional
         Tolerance for termination on the funcion, inputs and gradient. For detailed control, use solver-specific options.
     max_nfev : int, optionnal
@@ -46,7 +127,21 @@ def psfFitting(image,psfModelInst,x0,weights=None,fixed=None,method='trf',spectr
             0 : progress bar only
             1: number of iteration
             2: minimization details for each iteration
-        
+    numJacWorkers : int, optional
+        Number of processes used to evaluate the finite-difference Jacobian,
+        one PSF evaluation per free parameter and per iteration. Use -1 for
+        all the available cores; the default (1) keeps scipy's sequential
+        forward differences. Requires the fork start method (Linux/macOS).
+    trSolver : str, optional
+        Trust-region subproblem solver for the trf method: 'exact' (dense QR),
+        'lsmr' (iterative, avoids factorizing J and is cheaper for large
+        stamps) or 'auto' (default) to let the image size decide.
+    singlePrecision : bool, optional
+        Run the residual pipeline (image, weights, scratch buffers) in
+        float32 to halve the memory traffic; detector data is at most
+        16-bit so no information is lost. The confidence interval is
+        still derived in float64. Default: False.
+
     Returns
     -------
     out.x : numpy.array
@@ -71,6 +166,14 @@ def psfFitting(image,psfModelInst,x0,weights=None,fixed=None,method='trf',spectr
            Value of cost function at optimum
     """
     
+    # PRECISION
+    if singlePrecision:
+        # the scratch buffers and residuals inherit this dtype; the model
+        # output is cast on the fly when the residual is computed
+        image = np.asarray(image,dtype=np.float32)
+        if weights is not None:
+            weights = np.asarray(weights,dtype=np.float32)
+
     # WEIGHTS
     if weights is None: weights = np.ones_like(image)
     elif len(image)!=len(weights): raise ValueError("Keyword `weights` must have same number of elements as `psf`")
@@ -83,25 +186,105 @@ def psfFitting(image,psfModelInst,x0,weights=None,fixed=None,method='trf',spectr
     nPix = im_norm.shape[1]
     
     # DEFINING THE COST FUNCTIONS
+    # invariants of the minimization, hoisted out of the hot path
+    showProgress = method == 'lm' or verbose == 0 or verbose == 1
+    saturation   = psfModelInst.ao.cam.saturation/param
+    nPixModel    = im_norm.shape[0]
     class CostClass(object):
         def __init__(self):
             self.iter = 0
+            # scratch buffer reused at each iteration to avoid reallocating
+            # the intermediate residual arrays
+            self._tmp = np.empty_like(im_norm)
+            # last evaluated point and model image, reused after the
+            # minimization when the solver stops at an evaluated point
+            self.last_y  = None
+            self.last_im = None
+            # pending progress-bar dashes, written out in batches to avoid
+            # one stdout write (and flush) per iteration
+            self._progress = []
+        def flushProgress(self):
+            if self._progress:
+                sys.stdout.write(''.join(self._progress))
+                sys.stdout.flush()
+                self._progress.clear()
         def __call__(self,y):
-            if (self.iter%3)==0 and (method=='lm' or verbose == 0 or verbose == 1): print("-",end="")
+            if showProgress and (self.iter%3)==0:
+                self._progress.append('-')
+                if len(self._progress) == 20:
+                    self.flushProgress()
             self.iter += 1
-            im_est = imageModel(psfModelInst(mini2input(y),nPix=im_norm.shape[0]),
+            im_est = imageModel(psfModelInst(mini2input(y),nPix=nPixModel),
                                 spatialStacking=spatialStacking,spectralStacking=spectralStacking,
-                                saturation=psfModelInst.ao.cam.saturation/param)
-            
-            return (sqW * (im_est - im_norm)).reshape(-1)
-    cost = CostClass()   
-    
+                                saturation=saturation)
+            self.last_y  = np.copy(y)
+            self.last_im = im_est
+            # weighted residual computed in-place in the scratch buffer; a
+            # flattened copy is returned as least_squares keeps a reference
+            # to the previous residual across evaluations
+            if ne is not None and im_est.dtype == self._tmp.dtype:
+                # numexpr fuses the expression into a single multithreaded
+                # pass instead of two traversals
+                ne.evaluate('sqW*(im_est-im_norm)',
+                            local_dict={'sqW':sqW,'im_est':im_est,'im_norm':im_norm},
+                            out=self._tmp)
+            else:
+                np.subtract(im_est,im_norm,out=self._tmp)
+                np.multiply(self._tmp,sqW,out=self._tmp)
+            return self._tmp.reshape(-1).copy()
+    cost = CostClass()
+
+    # FINITE-DIFFERENCE JACOBIAN, OPTIONALLY COLUMN-PARALLEL
+    executor = None
+    if numJacWorkers != 1:
+        try:
+            ctx = mp.get_context('fork')
+        except ValueError:
+            ctx = None
+            print('WARNING : the fork start method is not available; the Jacobian is computed sequentially')
+        if ctx is not None:
+            global _JAC_COST
+            _JAC_COST = cost
+            nWorkers  = numJacWorkers if numJacWorkers > 1 else os.cpu_count()
+            executor  = ProcessPoolExecutor(max_workers=nWorkers,mp_context=ctx)
+
+    _jac_buf = {'J':None}
+    def jac_fd(y):
+        # each column is an independent PSF evaluation; spread over the
+        # worker processes when a pool is available
+        f0 = cost(y)
+        h  = np.sqrt(np.finfo(float).eps)*np.maximum(1.0,abs(y))
+        if method != 'lm':
+            # flip the step when it would cross the upper bound
+            h = np.where(y + h > b_up,-h,h)
+        ytrial = []
+        for i in range(len(y)):
+            yp     = np.copy(y)
+            yp[i] += h[i]
+            ytrial.append(yp)
+        if executor is not None:
+            cols = list(executor.map(_jac_column,ytrial))
+        else:
+            cols = [cost(yp) for yp in ytrial]
+        # the Jacobian buffer is reused across iterations; the solvers
+        # consume J before requesting a new one
+        J = _jac_buf['J']
+        if J is None or J.shape != (f0.size,len(y)):
+            J = np.empty((f0.size,len(y)))
+            _jac_buf['J'] = J
+        for i in range(len(y)):
+            J[:,i] = (cols[i] - f0)/h[i]
+        return J
+
+    jac = jac_fd if executor is not None else '2-point'
+
     # DEFINING THE BOUNDS
     if fixed is not None:
         if len(fixed)!=len(x0): raise ValueError("When defined, `fixed` must be same size as `x0`")
         FREE    = [not fixed[i] for i in range(len(fixed))]
         INDFREE = np.where(FREE)[0]
-        
+        xall_buffer = np.copy(x0) # reused by mini2input instead of copying x0 at each call
+
     def get_bounds(inst):
         if bounds == None:
             b_low = inst.bounds[0]
@@ -126,27 +309,56 @@ def psfFitting(image,psfModelInst,x0,weights=None,fixed=None,method='trf',spectr
             if forceZero:
                 xall = np.zeros_like(x0)
             else:
-                xall = np.copy(x0)
-            for i in range(len(y)):
-                xall[INDFREE[i]] = y[i]
+                xall = xall_buffer
+            xall[INDFREE] = y
         return xall
             
     # PERFORMING MINIMIZATION WITH CONSTRAINS AND BOUNDS
-    if method == 'trf':
-        result = least_squares(cost,input2mini(x0),method='trf',bounds=get_bounds(psfModelInst),\
-                               ftol=ftol, xtol=xtol, gtol=gtol,max_nfev=max_nfev,verbose=max(verbose,0))
-    else:
-        result = least_squares(cost,input2mini(x0),method='lm',\
-                               ftol=ftol, xtol=xtol, gtol=gtol,max_nfev=max_nfev,verbose=max(verbose,0))
+    try:
+        if method == 'trf':
+            b_low,b_up = get_bounds(psfModelInst)
+            if trSolver == 'auto':
+                # the dense QR factorization of J dominates for large stamps;
+                # switch to the matrix-free LSMR solve above 256x256
+                trSolver = 'lsmr' if im_norm.size > 256**2 else 'exact'
+            # cap the LSMR inner iterations: the subproblem only needs a
+            # rough solve for the outer LM step to make progress
+            trOptions = {'maxiter':20,'atol':1e-6} if trSolver == 'lsmr' else {}
+            # x_scale='jac' rescales the trust region from the Jacobian
+            # columns: the psfao21 parameters span orders of magnitude
+            # (r0 ~1e-1, background ~1e-4, flux ~1e5) and an unscaled
+            # region wastes iterations. diff_step makes the forward
+            # differences proportional to the parameter magnitude, well
+            # above floating-point noise.
+            result = least_squares(cost,input2mini(x0),method='trf',bounds=(b_low,b_up),jac=jac,\
+                                   tr_solver=trSolver,tr_options=trOptions,x_scale='jac',diff_step=1e-4,\
+                                   ftol=ftol, xtol=xtol, gtol=gtol,max_nfev=max_nfev,verbose=max(verbose,0))
+        elif method == 'lmq':
+            b_low,b_up = get_bounds(psfModelInst)
+            result = _lm_deferred(cost,jac_fd,input2mini(x0),bounds=(b_low,b_up),\
+                                  ftol=ftol, xtol=xtol, gtol=gtol, max_nfev=max_nfev)
+        else:
+            result = least_squares(cost,input2mini(x0),method='lm',jac=jac,\
+                                   ftol=ftol, xtol=xtol, gtol=gtol,max_nfev=max_nfev,verbose=max(verbose,0))
+    finally:
+        cost.flushProgress()
+        if executor is not None:
+            executor.shutdown()
+            _JAC_COST = None
 
     # update parameters
-    result.x      = mini2input(result.x)
+    y_opt         = result.x
+    result.x      = np.copy(mini2input(result.x))
     result.xinit  = x0
     result.im_sky = image
-    # scale fitted image
-    tmp           = imageModel(psfModelInst(result.x,nPix=nPix),
-                               spatialStacking=spatialStacking,spectralStacking=spectralStacking,
-                               saturation=psfModelInst.ao.cam.saturation/param)
+    # scale fitted image; the model image is reused when the solver stopped
+    # at the last evaluated point, saving one PSF evaluation
+    if cost.last_y is not None and np.array_equal(cost.last_y,y_opt):
+        tmp = cost.last_im
+    else:
+        tmp = imageModel(psfModelInst(result.x,nPix=nPix),
+                         spatialStacking=spatialStacking,spectralStacking=spectralStacking,
+                         saturation=psfModelInst.ao.cam.saturation/param)
     result.im_fit = FourierUtils.normalizeImage(tmp,param=param,normType=normType)
     result.im_dif = result.im_sky - result.im_fit
     # psf
@@ -168,7 +380,8 @@ def psfFitting(image,psfModelInst,x0,weights=None,fixed=None,method='trf',spectr
     
     # 95% confidence interval
     try:
-        result.xerr = mini2input(confidence_interval(result.fun,result.jac),forceZero=True)
+        result.xerr = mini2input(confidence_interval(np.asarray(result.fun,dtype=np.float64),
+                                                     np.asarray(result.jac,dtype=np.float64)),forceZero=True)
     except:
         print('Identification of the confidence interval failed ')
         result.xerr = list(-1 * np.ones_like(result.x))
@@ -176,13 +389,70 @@ def psfFitting(image,psfModelInst,x0,weights=None,fixed=None,method='trf',spectr
     return result
 
 
+_MULTISTART_ARGS = None
+
+def _multistart_worker(x0):
+    # run one fit in a worker process; the image, model and keywords are
+    # inherited from the parent process at fork time
+    image,psfModelInst,kwargs = _MULTISTART_ARGS
+    return psfFitting(image,psfModelInst,x0,**kwargs)
+
+def psfFitting_multistart(image,psfModelInst,x0_list,nWorkers=None,**kwargs):
+    """Run psfFitting from several initial guesses and return the best fit.
+
+    The fits are independent and compute-bound, so they are spread over a
+    pool of forked processes; forking inherits the PSF model instance
+    instead of pickling it for each start. Falls back to a sequential loop
+    when the fork start method is unavailable or nWorkers=1.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        The experimental image to be fitted
+    psfModelInst : class
+        The class representing the PSF model
+    x0_list : list
+        List of initial guesses, one per fit
+    nWorkers : int, optional
+        Number of worker processes (default: all the available cores)
+    **kwargs :
+        Forwarded to psfFitting
+
+    Returns
+    -------
+    The psfFitting result with the lowest cost among the starts.
+    """
+    global _MULTISTART_ARGS
+    if len(x0_list) == 0:
+        raise ValueError("`x0_list` must contain at least one initial guess")
+    try:
+        ctx = mp.get_context('fork')
+    except ValueError:
+        ctx = None
+    if ctx is None or nWorkers == 1 or len(x0_list) == 1:
+        results = [psfFitting(image,psfModelInst,x0,**kwargs) for x0 in x0_list]
+    else:
+        _MULTISTART_ARGS = (image,psfModelInst,kwargs)
+        try:
+            with ProcessPoolExecutor(max_workers=nWorkers or os.cpu_count(),mp_context=ctx) as ex:
+                results = list(ex.map(_multistart_worker,x0_list))
+        finally:
+            _MULTISTART_ARGS = None
+    return results[np.argmin([res.cost for res in results])]
+
 def evaluateFittingQuality(result,psfModelInst):
     
     # ESTIMATING IMAGE-BASED METRICS
     def meanErrors(sky,fit):
-        mse = 1e2*np.sqrt(np.sum((sky-fit)**2))/sky.sum()
-        mae = 1e2*np.sum(abs(sky-fit))/sky.sum()
-        fvu = 1e2*np.sum((sky-fit)**2)/np.sum((sky-sky.mean())**2)
+        # single pass over the difference: the squared sum goes through the
+        # BLAS dot and the buffer is reused for the absolute sum
+        d       = (sky - fit).ravel()
+        sse     = np.dot(d,d)
+        sae     = np.sum(np.abs(d,out=d))
+        sky_sum = sky.sum()
+        mse = 1e2*np.sqrt(sse)/sky_sum
+        mae = 1e2*sae/sky_sum
+        fvu = 1e2*sse/(sky.size*sky.var())
         return mse,mae,fvu
         
     if len(result.im_sky) == 2: